@@ -18,16 +18,26 @@
 # Graph looks like
 # e e e ...
 
+import json
 import math
+import multiprocessing
 import os
+import pickle
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 
 import numpy as np
 import scipy.fft as fft
-import yaml
 
 import covalent as ct
 
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
 benchmark_name = "parallel_cpumem"
 benchmark_dir = f"benchmark_results/{benchmark_name}/current"
 
@@ -37,46 +47,130 @@ if not os.path.isdir(benchmark_dir):
 widths = [2**i for i in range(4)]
 trials_per_width = 3
 
+# Kept outside of benchmark_dir so that postprocessing does not pick it up.
+# Absolute since executors may run tasks in a different working directory
+fftw_wisdom_file = os.path.abspath("benchmark_results/fftw_wisdom.pkl")
+os.makedirs(os.path.dirname(fftw_wisdom_file), exist_ok=True)
+
 
 # Single layer of independent electrons; half cpu and half mem
 # e e e ...
 
 
-def fft_test(width, n_iterations):
+# Wisdom is only a planning shortcut, so a missing, unreadable or
+# corrupt file is treated as having no wisdom. Returns the wisdom that
+# was imported, or None
+def load_fftw_wisdom():
+    try:
+        with open(fftw_wisdom_file, "rb") as f:
+            wisdom = pickle.load(f)
+        pyfftw.import_wisdom(wisdom)
+    except Exception:
+        return None
+    return wisdom
+
+
+# Written to a temporary file and renamed into place so that concurrent
+# tasks never read a partially written file
+def save_fftw_wisdom(wisdom):
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(fftw_wisdom_file))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(wisdom, f)
+        os.replace(tmpfile, fftw_wisdom_file)
+    except OSError:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+# Overwrites res to avoid allocating temporaries the size of the input
+def max_abs_error(X, res):
+    np.subtract(res, X, out=res)
+    np.abs(res, out=res)
+    return res.real.max()
+
+
+# Plans on aligned buffers; FFTW_MEASURE clobbers the buffers so both
+# plans must be built before any data is copied in. Saved wisdom keeps
+# repeat planning cheap; plans are not cached since Covalent serializes
+# this script's functions by value along with their globals
+def make_fftw_plans(width):
+    loaded = load_fftw_wisdom()
+    a = pyfftw.empty_aligned(width, dtype="complex64")
+    b = pyfftw.empty_aligned(width, dtype="complex64")
+    fft_obj = pyfftw.FFTW(
+        a, b, direction="FFTW_FORWARD", flags=("FFTW_MEASURE",), threads=os.cpu_count() or 1
+    )
+    ifft_obj = pyfftw.FFTW(
+        b, a, direction="FFTW_BACKWARD", flags=("FFTW_MEASURE",), threads=os.cpu_count() or 1
+    )
+
+    # Only rewrite the file when planning measured something new
+    wisdom = pyfftw.export_wisdom()
+    if wisdom != loaded:
+        save_fftw_wisdom(wisdom)
+    return a, fft_obj, ifft_obj
+
+
+# Runs in single precision, which is ample for transforms of this size
+# and halves the memory traffic. The normalization and round-trip error
+# check are only done when verify is set; the workflow itself discards
+# the result
+def fft_test(width, n_iterations, verify=True):
     gen = np.random.default_rng()
-    X = gen.random(width)
-    nX = np.sqrt(np.sum(X * X))
-    X /= nX
+    X = gen.random(width, dtype=np.float32)
+    if verify:
+        nX = np.sqrt(np.dot(X, X))
+        X /= nX
+
+    if pyfftw is None:
+        # All iterations as one batched transform along the last axis
+        res = fft.fft(np.broadcast_to(X, (n_iterations, width)), axis=-1, workers=-1)
+
+        if verify:
+            res = fft.ifft(res[-1], workers=-1)
+            return max_abs_error(X, res)
+        return
+
+    a, fft_obj, ifft_obj = make_fftw_plans(width)
     for i in range(n_iterations):
-        res = fft.fft(X)
+        a[:] = X
+        fft_obj()
 
-    res = fft.ifft(res)
-    return np.max(np.abs(X - res))
+    if verify:
+        res = ifft_obj()
+        return max_abs_error(X, res)
 
 
-# This uses about 600 MB on my system and completes in 3s
+# Set FFT_VERIFY to check the FFT round trip
 def sample_mem_task(*args, **kwargs):
-    fft_test(10000000, 3)
+    fft_test(10000000, 3, verify=__debug__ and bool(os.getenv("FFT_VERIFY")))
 
 
 def sample_task(*args, **kwargs):
     return 1
 
 
-def test_prime(n):
-    m = int(math.floor(math.sqrt(n)))
-    for d in range(2, m + 1):
-        if n % d == 0:
-            return False
-    return True
-
-
-# This takes 9s on my system
+# Sieve of Eratosthenes; entry i of the result is True iff i + 2 is prime
 def sample_cpu_task(*args, **kwargs):
-    res = []
-    for i in range(2, 1000000):
-        res.append(test_prime(i))
-    return res
+    n = 1000000
+    sieve = np.ones(n, dtype=np.bool_)
+    sieve[:2] = False
+    for p in range(2, math.isqrt(n - 1) + 1):
+        if sieve[p]:
+            sieve[p * p :: p] = False
+    return sieve[2:]
+
+
+# Returns a callable mapping a sequence to the tuple of its items at
+# the given indices; itemgetter alone returns a bare item for one index
+def gather(indices):
+    if len(indices) == 0:
+        return lambda seq: ()
+    if len(indices) == 1:
+        k = indices[0]
+        return lambda seq: (seq[k],)
+    return itemgetter(*indices)
 
 
 # General workflow with a feedforward transport graph
@@ -96,61 +190,109 @@ def feedforward_workflow(tasks, predecessors):
     task11 depends on task00, and task20 and task21 each depend only task11.
 
     """
-    electrons = [[ct.electron(tasks[0][j])() for j in range(len(tasks[0]))]]
+    # Electrons of all layers are stored in one flat list; layer i
+    # occupies electrons[offsets[i]:offsets[i + 1]]
+    offsets = [0]
+    for layer in tasks:
+        offsets.append(offsets[-1] + len(layer))
+    getters = [
+        [gather([offsets[i] + k for k in p]) for p in layer]
+        for i, layer in enumerate(predecessors)
+    ]
+
+    # Wrap each distinct task function as an electron only once per build
+    wrappers = {}
+    for layer in tasks:
+        for task in layer:
+            if task not in wrappers:
+                wrappers[task] = ct.electron(task)
+
+    electrons = [wrappers[tasks[0][j]]() for j in range(len(tasks[0]))]
     for i in range(1, len(tasks)):
-        next_electrons = []
         for j in range(len(tasks[i])):
-            args = [electrons[i - 1][k] for k in predecessors[i - 1][j]]
-            next_electrons.append(ct.electron(tasks[i][j])(*args))
-        electrons.append(next_electrons)
+            args = getters[i - 1][j](electrons)
+            electrons.append(wrappers[tasks[i][j]](*args))
     return 1
 
 
-# Without covalent
-for w in widths:
-    tasks = [[sample_cpu_task for i in range(w)]]
-    for i in range(int(w / 2), w):
-        tasks[0][i] = sample_mem_task
-
-    deps = []
-    for i in range(trials_per_width):
-        workflow = ct.lattice(feedforward_workflow)
-
-        start = time.time()
-        res = workflow(tasks, deps)
-        end = time.time()
-
-        outfile = f"{benchmark_dir}/no_ct_width_{w}_trial_{i}"
-        with open(outfile, "w") as f:
-            yaml.dump({"test": benchmark_name, "ct": False, "width": w, "runtime": end - start}, f)
-        print("(w/o ct) runtime for width {}: {} seconds".format(w, end - start))
-
-time.sleep(3)
-
-# With covalent
-for w in widths:
-    tasks = [[sample_cpu_task for i in range(w)]]
-    for i in range(int(w / 2), w):
-        tasks[0][i] = sample_mem_task
-
-    deps = []
-    for i in range(trials_per_width):
-        workflow = ct.lattice(feedforward_workflow)
-
-        result = ct.dispatch_sync(workflow)(tasks, deps)
-
-        assert result.status == ct.status.COMPLETED
-
-        outfile = f"{benchmark_dir}/{result.dispatch_id}"
-        with open(outfile, "w") as f:
-            yaml.dump(
-                {
-                    "test": benchmark_name,
-                    "ct": True,
-                    "dispatch_id": result.dispatch_id,
-                    "width": w,
-                    "runtime": (result.end_time - result.start_time).total_seconds(),
-                },
-                f,
+# Start every pool worker before timing; the pool spawns its processes
+# lazily, which would otherwise be counted in the first trial
+def warm_pool(pool, n_workers):
+    futures = [pool.submit(sample_task) for i in range(n_workers)]
+    for fut in futures:
+        fut.result()
+
+
+# Baseline trial: the independent tasks run concurrently in a process
+# pool, as Covalent would run them. Only single-layer graphs are
+# supported since tasks are submitted without their predecessors
+def run_trial(tasks, pool):
+    assert len(tasks) == 1
+    start = time.time()
+    futures = [pool.submit(task) for task in tasks[0]]
+    for fut in futures:
+        fut.result()
+    end = time.time()
+    return end - start
+
+
+# Guarded since the process pool may re-import this module in workers
+if __name__ == "__main__":
+    # Save FFTW wisdom for the mem task's transform up front so that the
+    # first timed trial does not pay for the measurement
+    if pyfftw is not None:
+        make_fftw_plans(10000000)
+
+    # Without covalent
+    for w in widths:
+        tasks = [[sample_cpu_task for i in range(w)]]
+        for i in range(int(w / 2), w):
+            tasks[0][i] = sample_mem_task
+
+        n_workers = min(os.cpu_count() or 1, w)
+        # Workers are spawned rather than forked since FFTW's planning
+        # above may have started threads in this process
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            warm_pool(pool, n_workers)
+            for i in range(trials_per_width):
+                runtime = run_trial(tasks, pool)
+
+                outfile = f"{benchmark_dir}/no_ct_width_{w}_trial_{i}.json"
+                with open(outfile, "w") as f:
+                    json.dump(
+                        {"test": benchmark_name, "ct": False, "width": w, "runtime": runtime}, f
+                    )
+                print("(w/o ct) runtime for width {}: {} seconds".format(w, runtime))
+
+    time.sleep(3)
+
+    # With covalent
+    workflow = ct.lattice(feedforward_workflow)
+    for w in widths:
+        tasks = [[sample_cpu_task for i in range(w)]]
+        for i in range(int(w / 2), w):
+            tasks[0][i] = sample_mem_task
+
+        deps = []
+        for i in range(trials_per_width):
+            result = ct.dispatch_sync(workflow)(tasks, deps)
+
+            assert result.status == ct.status.COMPLETED
+
+            outfile = f"{benchmark_dir}/{result.dispatch_id}.json"
+            with open(outfile, "w") as f:
+                json.dump(
+                    {
+                        "test": benchmark_name,
+                        "ct": True,
+                        "dispatch_id": result.dispatch_id,
+                        "width": w,
+                        "runtime": (result.end_time - result.start_time).total_seconds(),
+                    },
+                    f,
+                )
+            print(
+                "runtime for width {}: {} seconds".format(w, result.end_time - result.start_time)
             )
-        print("runtime for width {}: {} seconds".format(w, result.end_time - result.start_time))